@@ -163,8 +163,19 @@ class SyncConfig(ConfigReader):
 
     def optional_values(self):
         token_file = self.SYNC_DIR + "/auth_token.txt"
+        hash_file = self.SYNC_DIR + "/hashes.txt"
+        mirror_file = self.SYNC_DIR + "/mirror.txt"
+        journal_dir = self.SYNC_DIR + "/journals"
+        rate_file = self.SYNC_DIR + "/rate.txt"
+        attachment_file = self.SYNC_DIR + "/attachments.txt"
         return {"APPLICATION_NAME" : "notes-sync",
-                "TOKEN_FILE" : token_file}
+                "TOKEN_FILE" : token_file,
+                "HASH_FILE" : hash_file,
+                "MIRROR_FILE" : mirror_file,
+                "JOURNAL_DIR" : journal_dir,
+                "RATE_FILE" : rate_file,
+                "ATTACHMENT_FILE" : attachment_file,
+                "UPLOAD_THREADS" : "4"}
 
     def sensitive_fields(self):
         return self.SENSITIVE_FIELDS
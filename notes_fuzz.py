@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Differential fuzzing of the notes_parser engines.
+# Random notes are generated from a rough grammar of what notes look like,
+# with a bias towards the corners the README documents: tabs and spaces
+# counting the same for indentation, list elements continuing onto later
+# lines, and lines that are only just (or not quite) headers.  Each engine
+# must turn every input into exactly the same HTML as the frozen reference
+# parser in notes_reference.py.
+
+from notes_parser import Notes2HTML, ENGINES
+import notes_reference
+import random
+import sys
+import timeit
+
+WORDS = ["notes", "TODO", "Fix", "the", "BUILD", "x", "a.b", "&", "<tag>",
+         "\"quoted\"", "-", ":", "ok"]
+WHITESPACE = [" ", "\t"]
+
+def random_words(rng, caps=None):
+    """Gets a few random words.  If caps is True or False, the words are
+    all upper or lower case respectively"""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, 5))]
+    text = " ".join(words)
+    if caps is True:
+        text = text.upper()
+    elif caps is False:
+        text = text.lower()
+    return text
+
+def random_indent(rng, width):
+    """Gets width characters of whitespace, mixing tabs and spaces"""
+    return "".join(rng.choice(WHITESPACE) for _ in range(width))
+
+def header_lines(rng):
+    """Headers, along with lines that nearly have enough capitals to be"""
+    lines = []
+    for _ in range(rng.randint(1, 6)):
+        line = random_words(rng, rng.choice([True, None]))
+        if rng.random() < 0.5:
+            line += ":"
+        if rng.random() < 0.2:
+            line = random_indent(rng, 1) + line
+        lines.append(line)
+    return lines
+
+def list_lines(rng):
+    """Nested lists, with continuation lines and mixed indentation"""
+    lines = []
+    depth = 0
+    for _ in range(rng.randint(1, 10)):
+        depth = max(0, depth + rng.choice([-2, -1, 0, 0, 1, 2]))
+        lines.append("{0}-{1}".format(random_indent(rng, depth),
+                                      random_words(rng)))
+        if rng.random() < 0.3:
+            lines.append(random_indent(rng, rng.randint(0, depth + 1)) +
+                         random_words(rng))
+    return lines
+
+def free_text_lines(rng):
+    lines = [random_words(rng, rng.choice([False, None]))
+             for _ in range(rng.randint(1, 5))]
+    if rng.random() < 0.3:
+        lines.append(random_indent(rng, rng.randint(0, 3)))
+    return lines
+
+def reference_lines(rng):
+    return ["{0}[{1}]({2})".format(rng.choice(["", "!"]),
+                                   random_words(rng),
+                                   rng.choice(["a.png", "b c.png", "x)"]))
+            for _ in range(rng.randint(1, 3))]
+
+def deep_list_lines(rng):
+    """Lists indented far deeper than anyone would write by hand, as
+    happens with pasted code"""
+    depth = rng.randint(50, 200)
+    return ["{0}-{1}".format(random_indent(rng, rng.randint(0, depth)),
+                             random_words(rng))
+            for _ in range(depth)]
+
+def mixed_lines(rng):
+    lines = []
+    for _ in range(rng.randint(2, 8)):
+        lines.extend(rng.choice(MIXABLE)(rng))
+        if rng.random() < 0.5:
+            lines.append("")
+    return lines
+
+MIXABLE = [header_lines, list_lines, free_text_lines, reference_lines]
+
+# maps the name of each class of input to a function that makes
+# the lines of one random input of that class
+INPUT_CLASSES = {"headers": header_lines,
+                 "lists": list_lines,
+                 "free_text": free_text_lines,
+                 "references": reference_lines,
+                 "deep_lists": deep_list_lines,
+                 "mixed": mixed_lines}
+
+class ClassReport(object):
+    """The outcome of checking an engine against the reference on one
+    class of input.  mismatches holds the inputs whose HTML differed"""
+    def __init__(self, name, mismatches, reference_time, engine_time):
+        self.name = name
+        self.mismatches = mismatches
+        self.reference_time = reference_time
+        self.engine_time = engine_time
+
+    def speedup(self):
+        return self.reference_time / max(self.engine_time, 1e-9)
+
+def time_conversions(converter, inputs):
+    """Converts every input, returning the HTML and how long it took"""
+    start = timeit.default_timer()
+    outputs = [converter.convert_contents(lines) for lines in inputs]
+    return outputs, timeit.default_timer() - start
+
+def differential_run(engine, count=200, seed=0, classes=INPUT_CLASSES):
+    """Checks that the given engine (anything Notes2HTML accepts) turns
+    count random inputs of each class into the same HTML as the reference
+    parser.  Returns a list of ClassReports"""
+    reports = []
+    for name in sorted(classes):
+        rng = random.Random("{0}:{1}".format(seed, name))
+        inputs = [classes[name](rng) for _ in range(count)]
+        expected, reference_time = time_conversions(
+            Notes2HTML(notes_reference.NotesParser), inputs)
+        actual, engine_time = time_conversions(Notes2HTML(engine), inputs)
+        mismatches = [lines for lines, want, got
+                      in zip(inputs, expected, actual)
+                      if want != got]
+        reports.append(
+            ClassReport(name, mismatches, reference_time, engine_time))
+    return reports
+
+if __name__ == "__main__":
+    if len(sys.argv) in [2, 3] and sys.argv[1] in ENGINES:
+        count = int(sys.argv[2]) if len(sys.argv) == 3 else 200
+        reports = differential_run(sys.argv[1], count)
+        for report in reports:
+            print "{0:<12} {1:>4} mismatches  {2:.2f}x speedup".format(
+                report.name, len(report.mismatches), report.speedup())
+            for lines in report.mismatches[:3]:
+                print "    {0!r}".format("\n".join(lines))
+        if any(report.mismatches for report in reports):
+            sys.exit(1)
+    else:
+        print "Needs the name of an engine ({0}), and optionally how " \
+            "many inputs of each class to try.".format(", ".join(sorted(ENGINES)))
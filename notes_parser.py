@@ -19,6 +19,7 @@
 
 from abc import ABCMeta, abstractmethod
 from cgi import escape
+from xml.sax.saxutils import unescape
 import string
 import sys
 import re
@@ -32,6 +33,17 @@ class ParseResult(object):
         return (self.parsed == other.parsed and 
                 self.remaining == other.remaining)
 
+class IndexResult(object):
+    """What a parser produces when parsing from an index into a list of
+    lines.  end is the index of the first line that wasn't parsed"""
+    def __init__(self, parsed, end):
+        self.parsed = parsed
+        self.end = end
+
+    def __eq__(self, other):
+        return (self.parsed == other.parsed and
+                self.end == other.end)
+
 def concat_with_space(str1, str2):
     """Given two strings, it will concatenate 
     them so there is exactly one space in between them"""
@@ -61,13 +73,60 @@ def chomp_string(string, postfix):
         string = string[:up_to_postfix]
     return string
 
+class MemoTable(object):
+    """Remembers the IndexResults of parsers at indexes into a single
+    input, so that a parser is never run twice at the same index.
+    Holds at most max_size results, and starts over once it is full"""
+    DEFAULT_MAX_SIZE = 4096
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.table = {}
+
+    def clear(self):
+        """Must be called before moving on to a new input"""
+        self.table.clear()
+
+    def lookup(self, parser, index):
+        """Returns the remembered IndexResult, or None"""
+        return self.table.get((parser, index))
+
+    def store(self, parser, index, result):
+        if len(self.table) >= self.max_size:
+            self.table.clear()
+        self.table[(parser, index)] = result
+
 class Parser(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
+    def parse_at(self, lines, index):
+        """Parses lines starting from lines[index].
+        Returns an IndexResult"""
+        pass
+
     def parse(self, lines):
         """Returns a ParseResult"""
-        pass
+        res = self.parse_at(lines, 0)
+        return ParseResult(res.parsed, lines[res.end:])
+
+    def memoized(self, memo):
+        """Returns a version of this parser that remembers its
+        results in the given MemoTable"""
+        return MemoParser(self, memo)
+
+class MemoParser(Parser):
+    def __init__(self, parser, memo):
+        super(MemoParser, self).__init__()
+        self.parser = parser
+        self.memo = memo
+
+    def parse_at(self, lines, index):
+        result = self.memo.lookup(self.parser, index)
+        if result is None:
+            result = self.parser.parse_at(lines, index)
+            self.memo.store(self.parser, index, result)
+        return result
 
 def and_parsers(*parsers):
     if isinstance(parsers[0], tuple):
@@ -88,11 +147,38 @@ class AndParser(Parser):
         self.p1 = p1
         self.p2 = p2
 
-    def parse(self, lines):
-        p1Res = self.p1.parse(lines)
-        p2Res = self.p2.parse(p1Res.remaining)
-        return ParseResult(p1Res.parsed + p2Res.parsed,
-                           p2Res.remaining)
+    def parse_at(self, lines, index):
+        p1Res = self.p1.parse_at(lines, index)
+        p2Res = self.p2.parse_at(lines, p1Res.end)
+        return IndexResult(p1Res.parsed + p2Res.parsed,
+                           p2Res.end)
+
+def or_parsers(*parsers):
+    if isinstance(parsers[0], tuple):
+        parsers = parsers[0]
+
+    if len(parsers) < 2:
+        raise Exception("Not enough arguments to or_parsers")
+    elif len(parsers) == 2:
+        return OrParser(parsers[0],
+                        parsers[1])
+    else:
+        return OrParser(parsers[0],
+                        or_parsers(parsers[1:]))
+
+class OrParser(Parser):
+    """Tries p1, and only if that gets nowhere tries p2"""
+    def __init__(self, p1, p2):
+        super(OrParser, self).__init__()
+        self.p1 = p1
+        self.p2 = p2
+
+    def parse_at(self, lines, index):
+        p1Res = self.p1.parse_at(lines, index)
+        if p1Res.parsed != "":
+            return p1Res
+        else:
+            return self.p2.parse_at(lines, index)
 
 class HeaderParser(Parser):
     REGEX_STRING = "^[^\-.]+"
@@ -117,12 +203,12 @@ class HeaderParser(Parser):
         return "<h3>{0}</h3>\n".format(
             escape(HeaderParser.format_header(line)))
 
-    def parse(self, lines):
-        if len(lines) > 0 and self.is_header(lines[0]):
-            return ParseResult(self.to_header(lines[0]),
-                               lines[1:])
+    def parse_at(self, lines, index):
+        if index < len(lines) and self.is_header(lines[index]):
+            return IndexResult(self.to_header(lines[index]),
+                               index + 1)
         else:
-            return ParseResult("", lines)
+            return IndexResult("", index)
 
 class ListHeaderParser(Parser):
     REGEX_STRING = "^(\s*)-"
@@ -131,20 +217,40 @@ class ListHeaderParser(Parser):
     def __init__(self):
         super(ListHeaderParser, self).__init__()
 
-    def parse(self, lines):
-        if len(lines) == 0:
-            return ParseResult("", [])
-        else:
-            parsed = ""
-            remaining = lines
-            match = self.REGEX.match(lines[0])
-            if match:
-                leadingSize = len(match.groups()[0])
-                parsed = "<ul>\n"
-                inner = ListParser(leadingSize).parse(lines)
-                parsed += inner.parsed + "</ul>\n"
-                remaining = inner.remaining
-            return ParseResult(parsed, remaining)
+    @staticmethod
+    def list_indent(line):
+        """Gets the amount of whitespace before the "-" of a list
+        element, or None if the line isn't a list element"""
+        match = ListHeaderParser.REGEX.match(line)
+        return len(match.groups()[0]) if match else None
+
+    def parse_at(self, lines, index):
+        """Parses a whole list, including any nested lists, in a single
+        pass.  open_lists holds the indentation of each list that has been
+        opened but not yet closed, innermost last"""
+        parsed = []
+        open_lists = []
+        started = False
+
+        while index < len(lines):
+            num_in = self.list_indent(lines[index])
+            if num_in is None:
+                break
+            while open_lists and num_in < open_lists[-1]:
+                open_lists.pop()
+                parsed.append("</ul>\n")
+            if started and not open_lists: # dedented past the first element
+                break
+            if not open_lists or num_in > open_lists[-1]:
+                open_lists.append(num_in)
+                parsed.append("<ul>\n")
+            started = True
+            element = ListElementParser(num_in).parse_at(lines, index)
+            parsed.append("<li>{0}</li>\n".format(element.parsed))
+            index = element.end
+
+        parsed.append("</ul>\n" * len(open_lists))
+        return IndexResult("".join(parsed), index)
             
             
 class ListElementParser(Parser):
@@ -157,14 +263,9 @@ class ListElementParser(Parser):
 
         super(ListElementParser, self).__init__()
         self.num_in = num_in
-        regex_string_first_line = '^\s{{{0}}}-(.*)'.format(num_in)
-        self.regex_first_line = re.compile(regex_string_first_line)
-        regex_string_next_lines_whitespace = '^\s{{{0},}}'.format(num_in)
-        self.regex_next_lines_whitespace = \
-            re.compile(regex_string_next_lines_whitespace)
 
     def first_line_text(self, line):
-        return self.regex_first_line.match(line).groups()[0]
+        return line[self.num_in + 1:]
 
     def rest_lines_text(self, line):
         """Returns the text of the next lines, or None if it's not a valid
@@ -173,28 +274,28 @@ class ListElementParser(Parser):
         # quantifier, so a regex like:
         # ^\s{%s,}([^-].+) is insufficient in and of itself. It will backtrack
         # itself into accepting.
-        if self.regex_next_lines_whitespace.match(line):
+        if num_leading_whitespace(line) >= self.num_in:
             match = self.REGEX_NEXT_LINES_CONTENT.match(line.lstrip())
             if match:
                 return match.groups()[0]
         return None
         
-    def parse(self, lines):
+    def parse_at(self, lines, index):
         """Assumes that it will be initially called on a list element"""
 
-        parsed = self.first_line_text(lines[0])
-        lines = lines[1:]
+        parsed = self.first_line_text(lines[index])
+        index += 1
         done = False
 
-        while len(lines) > 0 and not done:
-            cur_line = self.rest_lines_text(lines[0])
+        while index < len(lines) and not done:
+            cur_line = self.rest_lines_text(lines[index])
             if cur_line:
                 parsed = concat_with_space(parsed, cur_line)
-                lines = lines[1:]
+                index += 1
             else:
                 done = True
 
-        return ParseResult(parsed, lines)
+        return IndexResult(parsed, index)
 
 
 class ListGroupParser(Parser):
@@ -203,56 +304,21 @@ class ListGroupParser(Parser):
         assumes that the list tag has already been started"""
         super(ListGroupParser, self).__init__()
         self.num_in = num_in
-        regex_string = '(^\s{{{0}}})-.*'.format(num_in)
-        self.regex = re.compile(regex_string)
 
-    def parse(self, lines):
+    def parse_at(self, lines, index):
         parsed = ""
         done = False
-        while lines and not done:
-            match = self.regex.match(lines[0])
-            if match:
-                element = ListElementParser(self.num_in).parse(lines)
+        element_parser = ListElementParser(self.num_in)
+        while index < len(lines) and not done:
+            if ListHeaderParser.list_indent(lines[index]) == self.num_in:
+                element = element_parser.parse_at(lines, index)
                 parsed += "<li>{0}</li>\n".format(element.parsed)
-                lines = element.remaining
+                index = element.end
             else:
                 done = True
 
-        return ParseResult(parsed, lines)
+        return IndexResult(parsed, index)
 
-class ListParser(Parser):
-    REGEX_STRING = '(^\s*)-.*'
-    REGEX = re.compile(REGEX_STRING)
-
-    def __init__(self, num_in=0):
-        """num_in is the number of whitespace we are in
-        assumes that the list tag has already been started"""
-        super(ListParser, self).__init__()
-        self.num_in = num_in
-
-    def parse(self, lines):
-        parsed = ""
-        done = False
-        while lines and not done:
-            match = self.REGEX.match(lines[0])
-            if match:
-                res = None
-                num_whitespace = len(match.groups()[0])
-                if num_whitespace == self.num_in:
-                    res = ListGroupParser(self.num_in).parse(lines)
-                elif num_whitespace > self.num_in:
-                    res = ListHeaderParser().parse(lines)
-                else: # leading < self.numIn
-                    done = True
-                
-                if res: # if we have something to add
-                    parsed += res.parsed
-                    lines = res.remaining
-            else:
-                done = True # if we didn't match
-
-        return ParseResult(parsed, lines)
-                    
 class BreakParser(Parser):
     REGEX_STRING = "^\s*$"
     REGEX = re.compile(REGEX_STRING)
@@ -260,55 +326,148 @@ class BreakParser(Parser):
     def __init__(self):
         super(BreakParser, self).__init__()
 
-    def parse(self, lines):
-        if lines and self.REGEX.match(lines[0]):
-            return ParseResult("<br/>\n", lines[1:])
+    def parse_at(self, lines, index):
+        if index < len(lines) and self.REGEX.match(lines[index]):
+            return IndexResult("<br/>\n", index + 1)
         else:
-            return ParseResult("", lines)
+            return IndexResult("", index)
+
+class ReferenceParser(Parser):
+    """Parses a line referring to another file, either as an image:
+    ![some description](diagram.png)
+    ...or as a link:
+    [some description](slides.pdf)"""
+    REGEX_STRING = "^\s*(!?)\[([^\]]*)\]\(([^)\s]+)\)\s*$"
+    REGEX = re.compile(REGEX_STRING)
+
+    def __init__(self):
+        super(ReferenceParser, self).__init__()
+
+    @staticmethod
+    def to_reference(is_image, text, target):
+        if is_image:
+            return "<p><img src=\"{0}\" alt=\"{1}\"/></p>\n".format(
+                escape(target, True), escape(text, True))
+        else:
+            return "<p><a href=\"{0}\">{1}</a></p>\n".format(
+                escape(target, True), escape(text or target))
+
+    def parse_at(self, lines, index):
+        match = self.REGEX.match(lines[index]) if index < len(lines) else None
+        if match:
+            is_image, text, target = match.groups()
+            return IndexResult(self.to_reference(is_image, text, target),
+                               index + 1)
+        else:
+            return IndexResult("", index)
 
 class NotesParser(Parser):
-    COMPOSITE_PARSER = and_parsers(HeaderParser(),
+    COMPOSITE_PARSER = and_parsers(ReferenceParser(),
+                                   HeaderParser(),
                                    ListHeaderParser(),
                                    BreakParser())
-    def __init__( self ):
+    def __init__( self, memoize=False ):
+        """If memoize is set, each element parser remembers its
+        results, so no element is parsed twice at the same position.
+        The elements are chained with and_parsers, which never tries
+        two of them at the same position, so for now the memo is almost
+        never hit and only costs time.  It is a hook for grammar rules
+        built with or_parsers, which do backtrack"""
         super(NotesParser, self).__init__()
-
-    def parse(self, lines):
-        parsed = ""
+        self.memo = None
+        self.composite = self.COMPOSITE_PARSER
+        if memoize:
+            self.memo = MemoTable()
+            self.composite = and_parsers(
+                ReferenceParser().memoized(self.memo),
+                HeaderParser().memoized(self.memo),
+                ListHeaderParser().memoized(self.memo),
+                BreakParser().memoized(self.memo))
+
+    def parse_at(self, lines, index):
+        parsed = []
         open_free_text = False
+        if self.memo is not None:
+            self.memo.clear()
 
-        while len(lines) > 0:
-            res = self.COMPOSITE_PARSER.parse(lines)
+        while index < len(lines):
+            res = self.composite.parse_at(lines, index)
             if res.parsed == "": # we got nowhere - free text
-                assert(res.remaining == lines)
+                assert(res.end == index)
                 if open_free_text: # already in open text
-                    parsed += escape(lines[0])
+                    parsed.append(escape(lines[index]))
                 else: # not already in open text
                     open_free_text = True
-                    parsed += "<p>{0} ".format(escape(lines[0]))
-                lines = lines[ 1: ]
+                    parsed.append("<p>{0} ".format(escape(lines[index])))
+                index += 1
             elif open_free_text: # we got past the free text
                 open_free_text = False
-                parsed += "</p>\n" + res.parsed
-                lines = res.remaining
+                parsed.append("</p>\n" + res.parsed)
+                index = res.end
             else: # parse not involving free text
-                parsed += res.parsed
-                lines = res.remaining
+                parsed.append(res.parsed)
+                index = res.end
 
         # if we ended with free text, then we still need to close it
         if open_free_text:
-            parsed += "</p>\n"
+            parsed.append("</p>\n")
             open_free_text = False
 
-        return ParseResult(parsed, [])
+        return IndexResult("".join(parsed), index)
 
 def to_lines(string):
     return string.split("\n")
 
+class Section(object):
+    """A run of converted notes beginning at a top-level header.
+    The title is None for whatever comes before the first header"""
+    def __init__(self, title, body):
+        self.title = title
+        self.body = body
+
+    def __eq__(self, other):
+        return (self.title == other.title and
+                self.body == other.body)
+
+SECTION_REGEX_STRING = "<h3>(.*)</h3>\n"
+SECTION_REGEX = re.compile(SECTION_REGEX_STRING)
+
+def split_sections(parsed):
+    """Splits parsed notes at each header.  The first section holds
+    everything before the first header, and may have an empty body"""
+    sections = []
+    title = None
+    start = 0
+    for match in SECTION_REGEX.finditer(parsed):
+        sections.append(Section(title, parsed[start:match.start()]))
+        title = unescape(match.groups()[0])
+        start = match.start()
+    sections.append(Section(title, parsed[start:]))
+    return sections
+
+# maps engine names to functions making a Parser that turns notes into HTML.
+# Every engine must produce exactly the same HTML as the frozen parser in
+# notes_reference.py (see notes_fuzz.py).  DEFAULT_ENGINE is the one used
+# unless told otherwise
+ENGINES = {"combinator": NotesParser,
+           # slower than "combinator" for now (see NotesParser)
+           "memoized": lambda: NotesParser(memoize=True)}
+DEFAULT_ENGINE = "combinator"
+
 class Notes2HTML(object):
     HTML_HEADER = \
         "<html xmlns=\"http://www.w3.org/1999/xhtml\" xml:lang=\"en\">"
 
+    def __init__(self, engine=DEFAULT_ENGINE):
+        """engine is either the name of one of the ENGINES, or a
+        function making a Parser"""
+        if callable(engine):
+            self.make_parser = engine
+        elif engine in ENGINES:
+            self.make_parser = ENGINES[engine]
+        else:
+            raise ValueError("Unknown engine: {0}".format(engine))
+
     @staticmethod
     def chomp(line):
         return chomp_string(line, "\n")
@@ -318,10 +477,18 @@ class Notes2HTML(object):
         with open(filename, "r") as fh:
             return to_lines(fh.read())
 
-    def convert_contents(self, contents):
+    def to_html(self, body):
         return "{0}{1}</html>\n".format(
             self.HTML_HEADER,
-            NotesParser().parse(contents).parsed)
+            body)
+
+    def convert_contents(self, contents):
+        return self.to_html(self.make_parser().parse(contents).parsed)
+
+    def convert_sections(self, contents):
+        """Like convert_contents, but returns a list of Sections
+        whose bodies have yet to be wrapped with to_html"""
+        return split_sections(self.make_parser().parse(contents).parsed)
 
     def convert_file(self, filename):
         return self.convert_contents(
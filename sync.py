@@ -3,8 +3,20 @@
 import gdata.sites.client
 import gdata.sites.data
 import gdata.gauth
+from multiprocessing.pool import ThreadPool
+from cgi import escape
+from xml.sax.saxutils import unescape
 import datetime
-import sys
+import fcntl
+import hashlib
+import json
+import mimetypes
+import optparse
+import re
+import tempfile
+import threading
+import time
+import urllib
 import config_reader
 import os.path
 
@@ -12,6 +24,10 @@ def parse_notes(lines):
     from notes_parser import Notes2HTML
     return Notes2HTML().convert_contents(lines)
 
+def parse_notes_sections(lines):
+    from notes_parser import Notes2HTML
+    return Notes2HTML().convert_sections(lines)
+
 def parse_markdown(lines):
     import markdown
     return markdown.markdown("\n".join(lines))
@@ -25,8 +41,492 @@ file_extension_parsers = {".htm": parse_html,
                           ".notes": parse_notes,
                           ".md": parse_markdown}
 
+# maps file extensions to functions that can split content of that type
+# into notes_parser.Sections, one per top-level header
+file_extension_splitters = {".notes": parse_notes_sections}
+
+def page_name_for_title(title):
+    """Gets the last part of the URL for a page with the given title"""
+    return re.sub("[^a-z0-9]+", "-", title.lower()).strip("-")
+
+class Chunk(object):
+    """A single subpage of chunked meeting minutes"""
+    def __init__(self, title, page_name, content):
+        self.title = title
+        self.page_name = page_name
+        self.content = content
+
+def chunk_sections(sections, parent_url):
+    """Turns a list of Sections into the content of an index page and
+    a list of Chunks, one per titled section.  Any text before the first
+    header stays on the index page, followed by links to each chunk.
+    parent_url is the last part of the index page's URL"""
+    from notes_parser import Notes2HTML
+    to_html = Notes2HTML().to_html
+    preamble = ""
+    chunks = []
+    used_names = set()
+    for section in sections:
+        if section.title is None:
+            preamble += section.body
+            continue
+        base_name = page_name_for_title(section.title) or "section"
+        page_name = base_name
+        suffix = 2
+        while page_name in used_names:
+            page_name = "{0}-{1}".format(base_name, suffix)
+            suffix += 1
+        used_names.add(page_name)
+        chunks.append(Chunk(section.title, page_name, to_html(section.body)))
+
+    links = "".join(
+        "<li><a href=\"{0}/{1}\">{2}</a></li>\n".format(
+            parent_url, chunk.page_name, escape(chunk.title))
+        for chunk in chunks)
+    return to_html("{0}<ul>\n{1}</ul>\n".format(preamble, links)), chunks
+
+def load_json(filename, default):
+    """Reads the JSON saved in the given file.  Returns default if there
+    is no such file, or if it can't be read (e.g. it was left half written
+    by an older version that died while saving)"""
+    try:
+        with open(filename, "r") as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return default
+
+def save_json(filename, value):
+    """Saves value to the given file as JSON.  The file is replaced in one
+    step, so neither a sync dying part way through nor a sync reading the
+    file at the same time can see it half written"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump(value, fh)
+        os.rename(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+class HashManifest(object):
+    """Remembers a hash of the content last uploaded to each page,
+    keyed by the page's path relative to the site"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.hashes = load_json(filename, {})
+
+    @staticmethod
+    def content_hash(content):
+        return hashlib.sha1(content).hexdigest()
+
+    def unchanged(self, path, content):
+        return self.hashes.get(path) == self.content_hash(content)
+
+    def record(self, path, content):
+        self.record_hash(path, self.content_hash(content))
+
+    def record_hash(self, path, content_hash):
+        self.hashes[path] = content_hash
+
+    def forget_below(self, path):
+        """Forgets the hashes of all pages under the given path"""
+        prefix = path + "/"
+        for key in [k for k in self.hashes if k.startswith(prefix)]:
+            del self.hashes[key]
+
+    def save(self):
+        save_json(self.filename, self.hashes)
+
+class AttachmentManifest(object):
+    """Remembers the URL of every file uploaded as an attachment,
+    keyed by a hash of the file's content"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.urls = load_json(filename, {})
+
+    def url_for(self, content_hash):
+        """Gets the URL of the uploaded file, or None if it hasn't been"""
+        return self.urls.get(content_hash)
+
+    def record(self, content_hash, url):
+        self.urls[content_hash] = url
+
+    def save(self):
+        save_json(self.filename, self.urls)
+
+REFERENCE_REGEX_STRING = '(src|href)="([^"]*)"'
+REFERENCE_REGEX = re.compile(REFERENCE_REGEX_STRING)
+URL_SCHEME_REGEX_STRING = "^[a-zA-Z][a-zA-Z0-9+.-]*:"
+URL_SCHEME_REGEX = re.compile(URL_SCHEME_REGEX_STRING)
+# stands in for a local file in HTML until the file is uploaded,
+# followed by the hash of the file's content
+ATTACHMENT_SCHEME = "attachment:"
+
+def local_file(reference, base_dir):
+    """Gets the name of the local file that a src or href attribute
+    refers to, or None if it doesn't refer to an existing local file.
+    Relative references are relative to base_dir.  Only files under
+    base_dir count, so that notes can't pull in any file on the machine
+    (e.g. src="/home/me/.ssh/id_rsa" or src="../../secret.txt")"""
+    reference = unescape(reference, {"&quot;": '"'})
+    if not reference or URL_SCHEME_REGEX.match(reference):
+        return None
+    base_dir = os.path.realpath(base_dir)
+    filename = os.path.realpath(os.path.join(base_dir, reference))
+    if not filename.startswith(os.path.join(base_dir, "")):
+        return None
+    return filename if os.path.isfile(filename) else None
+
+def local_references(content, base_dir):
+    """Maps each src or href attribute value in the given HTML that refers
+    to a local file to that file's name"""
+    references = {}
+    for match in REFERENCE_REGEX.finditer(content):
+        reference = match.groups()[1]
+        filename = local_file(reference, base_dir)
+        if filename:
+            references[reference] = filename
+    return references
+
+def pinned_hashes(content):
+    """Gets the content hashes of the files that the given HTML refers to
+    through ATTACHMENT_SCHEME references"""
+    return set(reference[len(ATTACHMENT_SCHEME):]
+               for _, reference in REFERENCE_REGEX.findall(content)
+               if reference.startswith(ATTACHMENT_SCHEME))
+
+def replace_references(content, urls):
+    """Replaces the src and href attribute values in the given HTML found
+    in urls with the URLs they map to"""
+    def replace(match):
+        attribute, reference = match.groups()
+        if reference in urls:
+            return '{0}="{1}"'.format(attribute, escape(urls[reference], True))
+        return match.group(0)
+    return REFERENCE_REGEX.sub(replace, content)
+
+def journal_filename(directory, filename):
+    """Gets where the journal for syncing the given input file is kept,
+    so that syncs of different files never share a journal"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(directory, key + ".txt")
+
+class SyncJournal(object):
+    """A write-ahead journal of how far each page of a sync got, so that
+    an interrupted sync can be resumed.  Each line is a JSON record of a
+    page's path, the hash of its content, and the last state it reached:
+    "converted", "looked-up", "deleted" or "created".  The records of an
+    unfinished sync are kept in previous.  The journal stays locked while
+    it is open, so two syncs can't share it"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.previous = {}
+        self.fh = self.open_locked()
+        torn = False
+        for line in self.fh:
+            torn = not line.endswith("\n")
+            try:
+                record = json.loads(line)
+            except ValueError: # torn write as the sync died
+                continue
+            self.previous[record["path"]] = record
+        self.fh.seek(0, os.SEEK_END)
+        if torn:
+            self.fh.write("\n")
+
+    def open_locked(self):
+        """Opens the journal for appending, holding its lock"""
+        while True:
+            fh = open(self.filename, "a+")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fh.close()
+                raise Exception(
+                    "Another sync is using the journal {0}".format(
+                        self.filename))
+            try:
+                current = os.stat(self.filename).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(fh.fileno()).st_ino:
+                fh.seek(0)
+                return fh
+            # a sync that just finished removed the file we locked
+            fh.close()
+
+    def unfinished(self):
+        """Whether the journal holds the records of a sync that never
+        finished"""
+        return os.fstat(self.fh.fileno()).st_size > 0
+
+    def start_over(self):
+        """Discards the records of the unfinished sync"""
+        with self.lock:
+            self.fh.seek(0)
+            self.fh.truncate()
+            self.previous.clear()
+
+    def write(self, path, content_hash, state, **extra):
+        """Records that the page at path has reached the given state.
+        The record is on disk by the time this returns"""
+        record = dict(extra, path=path, hash=content_hash, state=state)
+        with self.lock:
+            self.fh.write(json.dumps(record) + "\n")
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            if state in ["deleted", "created"]:
+                # what the interrupted sync did to the page no longer holds
+                self.previous.pop(path, None)
+
+    def previous_record(self, path, content_hash):
+        """Gets the interrupted sync's last record for path, provided it
+        was for the same content, or None"""
+        record = self.previous.get(path)
+        if record and record["hash"] == content_hash:
+            return record
+        return None
+
+    def previously_deleted(self, path):
+        """Gets the interrupted sync's record of deleting the page at path,
+        if it didn't write down creating the replacement, or None"""
+        record = self.previous.get(path)
+        if record and record["state"] == "deleted":
+            return record
+        return None
+
+    def created(self):
+        """Gets (path, hash) pairs for every page the interrupted sync
+        finished creating"""
+        return [(path, record["hash"])
+                for path, record in self.previous.items()
+                if record["state"] == "created"]
+
+    def finish(self):
+        """Removes the journal of a sync that has completed, since there
+        is nothing left to resume"""
+        os.remove(self.filename)
+        self.fh.close()
+
+class RateGovernor(object):
+    """Paces requests to the site with a token bucket kept in a file, so
+    that every sync running at once draws from the same bucket.  The rate
+    adapts as requests complete: it creeps up while the site answers
+    quickly, and is cut back when the site slows down or throttles us"""
+    INITIAL_RATE = 2.0 # requests per second
+    MIN_RATE = 0.1
+    MAX_RATE = 20.0
+    RATE_INCREASE = 0.05
+    SLOW_DECREASE = 0.8
+    THROTTLED_DECREASE = 0.5
+    SLOW_LATENCY = 2.0 # seconds
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def initial_state(self):
+        return {"rate": self.INITIAL_RATE,
+                "tokens": 1.0,
+                "stamp": time.time()}
+
+    def with_state(self, update):
+        """Calls update on the shared state while holding the file's lock,
+        saving whatever changes it makes.  Returns what update returns"""
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, "r+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.loads(fh.read())
+                except ValueError:
+                    state = self.initial_state()
+                result = update(state)
+                fh.seek(0)
+                fh.truncate()
+                fh.write(json.dumps(state))
+                fh.flush()
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        return result
+
+    def take_token(self, state):
+        """Refills the bucket for the time since it was last touched, and
+        takes a token if there is one.  Returns how long to wait before
+        trying again, or 0 if a token was taken"""
+        now = time.time()
+        elapsed = max(0.0, now - state["stamp"])
+        capacity = max(1.0, state["rate"])
+        state["tokens"] = min(capacity,
+                              state["tokens"] + elapsed * state["rate"])
+        state["stamp"] = now
+        if state["tokens"] >= 1.0:
+            state["tokens"] -= 1.0
+            return 0
+        else:
+            return (1.0 - state["tokens"]) / state["rate"]
+
+    def acquire(self):
+        """Waits until a request may be made"""
+        wait = self.with_state(self.take_token)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.with_state(self.take_token)
+
+    def adjust_rate(self, state, latency, throttled):
+        if throttled:
+            rate = state["rate"] * self.THROTTLED_DECREASE
+        elif latency > self.SLOW_LATENCY:
+            rate = state["rate"] * self.SLOW_DECREASE
+        else:
+            rate = state["rate"] + self.RATE_INCREASE
+        state["rate"] = min(self.MAX_RATE, max(self.MIN_RATE, rate))
+
+    def report(self, latency, throttled):
+        """Tells the governor how long a request took, and whether the
+        site throttled it"""
+        self.with_state(
+            lambda state: self.adjust_rate(state, latency, throttled))
+
+class MirroredPage(object):
+    """What we remember about a single page on the site"""
+    def __init__(self, page_id, parent_id, page_name, edit_link):
+        self.id = page_id
+        self.parent_id = parent_id
+        self.page_name = page_name
+        self.edit_link = edit_link
+
+    @staticmethod
+    def from_entry(entry):
+        page_name = entry.page_name.text if entry.page_name else None
+        return MirroredPage(entry.id.text,
+                            entry.FindParentLink(),
+                            page_name,
+                            entry.GetEditLink().href)
+
+    def to_list(self):
+        return [self.id, self.parent_id, self.page_name, self.edit_link]
+
+class PageMirror(object):
+    """A local copy of the page tree under the meeting minutes page,
+    so that pages can be looked up by path without asking the site.
+    root_path is the path of the meeting minutes page relative to the
+    site; if it differs from what was saved, the saved tree is dropped.
+    root_id is the root's entry id, which is what parent links refer to,
+    while root_node_id is the shorter id that feed queries take.
+    Chunks are uploaded from several threads at once, so everything
+    touching the tree holds lock"""
+    def __init__(self, filename, root_path):
+        self.filename = filename
+        self.root_path = root_path
+        self.root_id = None
+        self.root_node_id = None
+        self.updated = None
+        self.pages = {}
+        self.paths = None
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Loads the saved tree.  If there is none, or it can't be read,
+        root_id stays None so that the next refresh fetches everything"""
+        saved = load_json(self.filename, {})
+        if (saved.get("root_path") == self.root_path and
+            saved.get("root_node_id")):
+            self.root_id = saved["root_id"]
+            self.root_node_id = saved["root_node_id"]
+            self.updated = saved["updated"]
+            for fields in saved["pages"]:
+                page = MirroredPage(*fields)
+                self.pages[page.id] = page
+
+    def save(self):
+        with self.lock:
+            pages = [page.to_list() for page in self.pages.values()]
+        save_json(self.filename,
+                  {"root_path": self.root_path,
+                   "root_id": self.root_id,
+                   "root_node_id": self.root_node_id,
+                   "updated": self.updated,
+                   "pages": pages})
+
+    def path_of(self, page):
+        """Gets the path of the given page relative to the site, or None
+        if the page is not reachable from the root"""
+        names = []
+        with self.lock:
+            while page is not None and page.page_name is not None:
+                names.append(page.page_name)
+                if page.parent_id == self.root_id:
+                    names.append(self.root_path)
+                    return "/".join(reversed(names))
+                page = self.pages.get(page.parent_id)
+        return None
+
+    def find(self, path):
+        """Gets the MirroredPage at the given path, or None"""
+        with self.lock:
+            if self.paths is None:
+                self.paths = {}
+                for page in self.pages.values():
+                    page_path = self.path_of(page)
+                    if page_path is not None:
+                        self.paths[page_path] = page
+            return self.paths.get(path)
+
+    def add_page(self, page):
+        with self.lock:
+            replacing = page.id in self.pages
+            self.pages[page.id] = page
+            if replacing or self.paths is None:
+                # the paths of anything below the page may have changed
+                self.paths = None
+            else:
+                page_path = self.path_of(page)
+                if page_path is not None:
+                    self.paths[page_path] = page
+        return page
+
+    def add_entry(self, entry):
+        return self.add_page(MirroredPage.from_entry(entry))
+
+    def remove(self, page_id):
+        """Removes the given page along with everything below it"""
+        with self.lock:
+            doomed = set([page_id])
+            found_more = True
+            while found_more:
+                below = [page.id for page in self.pages.values()
+                         if page.parent_id in doomed and
+                         page.id not in doomed]
+                doomed.update(below)
+                found_more = bool(below)
+            for doomed_id in doomed:
+                self.pages.pop(doomed_id, None)
+            self.paths = None
+
+    def apply_entries(self, entries):
+        """Brings the mirror up to date with entries from a content feed"""
+        for entry in entries:
+            if getattr(entry, "deleted", None) is not None:
+                self.remove(entry.id.text)
+            else:
+                self.add_entry(entry)
+
 class SitesCommunicator(object):
-    def __init__(self):
+    # how many entries to ask for per page of a content feed
+    FEED_PAGE_SIZE = 200
+    # HTTP statuses the site uses to say we're making too many requests
+    THROTTLED_STATUSES = frozenset([429, 503])
+    # how many times to retry a request that was throttled
+    THROTTLED_RETRIES = 3
+
+    def __init__(self, filename, resume=False):
+        """filename is the input file being synced.  If resume is set,
+        carries on from the journal of a sync of it that was interrupted"""
         self.feed = None
         self.config = config = config_reader.SyncConfig()
         self.APPLICATION_NAME = config['APPLICATION_NAME']
@@ -35,12 +535,49 @@ class SitesCommunicator(object):
         self.SITE = config['SITE']
         self.TOKEN_FILE = os.path.expanduser(config['TOKEN_FILE'])
         self.MEETING_MINUTES = config['MEETING_MINUTES']
+        self.UPLOAD_THREADS = int(config['UPLOAD_THREADS'])
+        self.hashes = HashManifest(
+            os.path.expanduser(config['HASH_FILE']))
+        self.mirror = PageMirror(
+            os.path.expanduser(config['MIRROR_FILE']),
+            self.MEETING_MINUTES)
+        self.mirror_refreshed = False
+        self.root = None
+        self.open_journal(os.path.expanduser(config['JOURNAL_DIR']),
+                          filename,
+                          resume)
+        self.governor = RateGovernor(
+            os.path.expanduser(config['RATE_FILE']))
+        self.attachments = AttachmentManifest(
+            os.path.expanduser(config['ATTACHMENT_FILE']))
+        self.attachment_files = {}
+        self.attachment_lock = threading.Lock()
         self.client = gdata.sites.client.SitesClient(
             source=self.APPLICATION_NAME,
             site=self.SITE)
         self.client.ssl = True
         self.auth_client()
 
+    def remote(self, call, *args, **kwargs):
+        """Makes a request to the site through the given client method,
+        paced by the rate governor.  Throttled requests are retried"""
+        retries = 0
+        while True:
+            self.governor.acquire()
+            start = time.time()
+            try:
+                result = call(*args, **kwargs)
+            except gdata.client.RequestError as error:
+                throttled = (getattr(error, "status", None) in
+                             self.THROTTLED_STATUSES)
+                self.governor.report(time.time() - start, throttled)
+                if not throttled or retries == self.THROTTLED_RETRIES:
+                    raise
+                retries += 1
+            else:
+                self.governor.report(time.time() - start, False)
+                return result
+
     def write_token(self, token):
         fh = open(self.TOKEN_FILE, "w")
         fh.write(token.token_string)
@@ -51,13 +588,14 @@ class SitesCommunicator(object):
         handles token-related things"""
         print 'Please visit ' + challenge.captcha_url
         answer = raw_input('Answer to the challenge? ')
-        token = self.client.ClientLogin(
+        token = self.remote(
+            self.client.ClientLogin,
             self.EMAIL, self.PASSWORD,
             self.APPLICATION_NAME,
             captcha_token=challenge.captcha_token,
             captcha_response=answer)
         self.write_token(token)
-        self.feed = self.client.GetSiteFeed()
+        self.feed = self.remote(self.client.GetSiteFeed)
 
     def auth_client_with_token(self):
         """Attempts to authenticate a client with a saved token
@@ -67,7 +605,7 @@ class SitesCommunicator(object):
             token = fh.read()
             fh.close()
             self.client.auth_token = gdata.gauth.ClientLoginToken(token)
-            self.feed = self.client.GetSiteFeed()
+            self.feed = self.remote(self.client.GetSiteFeed)
             return True
         except gdata.client.CaptchaChallenge as challenge:
             self.handle_captcha_challenge(challenge)
@@ -77,24 +615,34 @@ class SitesCommunicator(object):
     def auth_client(self):
         if not self.auth_client_with_token():
             try:
-                self.client.ClientLogin(
+                self.remote(
+                    self.client.ClientLogin,
                     self.EMAIL, self.PASSWORD,
                     self.APPLICATION_NAME)
                 self.write_token(self.client.auth_token)
-                self.feed = self.client.GetSiteFeed()
+                self.feed = self.remote(self.client.GetSiteFeed)
             except gdata.client.CaptchaChallenge as challenge:
                 self.handle_captcha_challenge(challenge)
 
-    def meeting_minute_name(self):
-        """Gets the name of the meeting minute for this date"""
+    def meeting_minute_name(self, date=None):
+        """Gets the name of the meeting minute for the given date,
+        which defaults to today"""
+        date = date or datetime.datetime.now()
         return "Minutes for {0}".format(
-            datetime.datetime.now().strftime("%b %d, %Y"))
+            date.strftime("%b %d, %Y"))
 
-    def meeting_minute_url( self ):
-        """Gets the url that will be generated for today's meeting minute name
+    def meeting_minute_url( self, date=None ):
+        """Gets the url that will be generated for the meeting minute name
         note that it only returns the last part of the URL"""
+        date = date or datetime.datetime.now()
         return "minutes-for-{0}".format(
-            datetime.datetime.now().strftime( "%b-%d-%Y" ).lower())
+            date.strftime( "%b-%d-%Y" ).lower())
+
+    def meeting_minute_path(self, date=None):
+        """Gets the path of the meeting minute, relative to the site"""
+        return "{0}/{1}".format(
+            self.MEETING_MINUTES,
+            self.meeting_minute_url(date))
 
     def content_entry_for_url(self, relative):
         """Amazingly, this is non-trivial to do.  The API claims there is a way to
@@ -107,25 +655,226 @@ class SitesCommunicator(object):
 
         absolute = "{0}?path={1}".format(
             self.client.MakeContentFeedUri(), relative)
-        return self.client.GetContentFeed(uri=absolute).entry
+        return self.remote(self.client.GetContentFeed, uri=absolute).entry
 
-    def make_meeting_minute_blindly(self, content):
-        """Takes the HTML content
-        assumes that the page doesn't already exist"""
-        parent = self.content_entry_for_url(self.MEETING_MINUTES)[0]
-        self.client.CreatePage(
+    def content_feed_entries(self, params):
+        """Gets every entry of the content feed matching the given query
+        parameters, following the feed's next links as needed.
+        Returns the feed's updated time along with the entries"""
+        uri = "{0}?{1}".format(
+            self.client.MakeContentFeedUri(),
+            urllib.urlencode(params))
+        feed = self.remote(self.client.GetContentFeed, uri=uri)
+        updated = feed.updated.text
+        entries = list(feed.entry)
+        next_link = feed.GetNextLink()
+        while next_link:
+            feed = self.remote(self.client.GetContentFeed,
+                               uri=next_link.href)
+            entries.extend(feed.entry)
+            next_link = feed.GetNextLink()
+        return updated, entries
+
+    def root_entry(self):
+        """Gets the ContentEntry of the meeting minutes page, which is
+        only fetched once"""
+        if self.root is None:
+            self.root = self.content_entry_for_url(self.MEETING_MINUTES)[0]
+        return self.root
+
+    def refresh_mirror(self):
+        """Brings the local mirror of the meeting minutes up to date.
+        The first time, every page under the meeting minutes is fetched.
+        Afterwards, only pages changed since the last refresh are"""
+        if self.mirror.root_id is None:
+            root = self.root_entry()
+            self.mirror.root_id = root.id.text
+            self.mirror.root_node_id = root.GetNodeId()
+        params = {"ancestor": self.mirror.root_node_id,
+                  "max-results": self.FEED_PAGE_SIZE}
+        if self.mirror.updated:
+            params["updated-min"] = self.mirror.updated
+            params["include-deleted"] = "true"
+        updated, entries = self.content_feed_entries(params)
+        self.mirror.apply_entries(entries)
+        self.mirror.updated = updated
+        self.mirror.save()
+        self.mirror_refreshed = True
+
+    def find_page(self, path):
+        """Returns the MirroredPage at the given path relative to the site,
+        or None if there is no such page"""
+        if not self.mirror_refreshed:
+            self.refresh_mirror()
+        return self.mirror.find(path)
+
+    def create_page(self, title, content, parent_id, page_name=None):
+        """Creates a page, returning its MirroredPage.  Any files that
+        content refers to are uploaded first (see pin_attachments)"""
+        html = self.upload_attachments(content)
+        entry = self.remote(
+            self.client.CreatePage,
             'webpage',
-            self.meeting_minute_name(),
-            html=content,
-            parent=parent)
-
-    def get_meeting_minute_page(self):
-        """Returns the meeting minute page for today, 
-        or None if one doesn't already exist"""
-        content = self.content_entry_for_url("{0}/{1}".format(
-                self.MEETING_MINUTES,
-                self.meeting_minute_url()))
-        return content[0] if content else None
+            title,
+            html=html,
+            page_name=page_name,
+            parent=parent_id)
+        page = self.mirror.add_entry(entry)
+        self.journal.write(self.mirror.path_of(page),
+                           self.hashes.content_hash(content),
+                           "created")
+        return page
+
+    def delete_page(self, page, replacement):
+        """Deletes a page that is about to be replaced with the
+        given content"""
+        path = self.mirror.path_of(page)
+        self.remote(self.client.Delete, page.edit_link, force=True)
+        self.mirror.remove(page.id)
+        self.journal.write(path,
+                           self.hashes.content_hash(replacement),
+                           "deleted",
+                           page_id=page.id)
+
+    def lookup_page(self, path, content):
+        """Returns the MirroredPage at the given path that is to get the
+        given content, or None.  A page that the interrupted sync deleted
+        is treated as missing, even if the mirror has yet to notice.  If
+        a different page is there, the interrupted sync created the
+        replacement but died before writing that down"""
+        existing = self.find_page(path)
+        deleted = self.journal.previously_deleted(path)
+        if existing and deleted and existing.id == deleted["page_id"]:
+            self.mirror.remove(existing.id)
+            existing = None
+        elif existing and deleted:
+            self.journal.write(path, deleted["hash"], "created")
+            self.hashes.record_hash(path, deleted["hash"])
+        self.journal.write(path,
+                           self.hashes.content_hash(content),
+                           "looked-up",
+                           exists=existing is not None)
+        return existing
+
+    def confirm_overwrite(self, path, content):
+        """Asks whether to overwrite the existing page at path with the
+        given content, unless that was already answered during the
+        interrupted sync"""
+        content_hash = self.hashes.content_hash(content)
+        previous = self.journal.previous_record(path, content_hash)
+        if previous and "overwrite" in previous:
+            overwrite = previous["overwrite"]
+        else:
+            overwrite = self.yes_no_prompt("Overwrite existing minutes")
+        self.journal.write(path, content_hash, "looked-up",
+                           exists=True, overwrite=overwrite)
+        return overwrite
+
+    def open_journal(self, directory, filename, resume):
+        """Opens the journal for syncing the given input file.  The pages
+        that an interrupted sync of it created count as uploaded"""
+        self.journal = SyncJournal(journal_filename(directory, filename))
+        if self.journal.unfinished() and not resume:
+            self.discard_unfinished_sync(filename)
+        for path, content_hash in self.journal.created():
+            self.hashes.record_hash(path, content_hash)
+
+    def discard_unfinished_sync(self, filename):
+        """Starts over from an unfinished sync of the given file, but only
+        with the user's go-ahead"""
+        if self.yes_no_prompt(
+                "A sync of {0} never finished. Start over".format(filename)):
+            self.journal.start_over()
+        else:
+            raise Exception(
+                "Rerun with --resume to finish the sync of {0}".format(
+                    filename))
+
+    def finish(self):
+        """To be called once everything has been synced"""
+        self.journal.finish()
+
+    def upload_attachment(self, filename, content_hash, parent):
+        """Uploads the given file as an attachment of the meeting minutes
+        page, whose ContentEntry is parent.  The attachment is named after
+        its content so that it can be shared by every day's minutes"""
+        title = "{0}-{1}".format(content_hash[:12],
+                                 os.path.basename(filename))
+        content_type = (mimetypes.guess_type(filename)[0] or
+                        "application/octet-stream")
+        entry = self.remote(
+            self.client.UploadAttachment,
+            filename,
+            parent,
+            content_type=content_type,
+            title=title)
+        self.attachments.record(content_hash,
+                                entry.GetAlternateLink().href)
+
+    def pin_attachments(self, content, base_dir):
+        """Returns the given HTML with each reference to a local file
+        replaced by an ATTACHMENT_SCHEME reference to the file's content.
+        Such HTML changes whenever a file it refers to does, but nothing
+        is uploaded until a page is created with it.  Relative references
+        are relative to base_dir"""
+        pins = {}
+        for reference, filename in local_references(content,
+                                                    base_dir).items():
+            with open(filename, "rb") as fh:
+                content_hash = HashManifest.content_hash(fh.read())
+            self.attachment_files[content_hash] = filename
+            pins[reference] = ATTACHMENT_SCHEME + content_hash
+        return replace_references(content, pins)
+
+    def upload_attachments(self, content):
+        """Uploads the files that the given HTML from pin_attachments
+        refers to, concurrently, and returns the HTML referring to the
+        uploaded copies instead.  Files whose content has been uploaded
+        before are not sent again"""
+        hashes = [content_hash for content_hash in pinned_hashes(content)
+                  if content_hash in self.attachment_files]
+        if not hashes:
+            return content
+
+        # chunks are created from several threads at once, and may share
+        # files that need only be uploaded once
+        with self.attachment_lock:
+            missing = [content_hash for content_hash in hashes
+                       if not self.attachments.url_for(content_hash)]
+            parent = self.root_entry() if missing else None
+            def upload(content_hash):
+                self.upload_attachment(self.attachment_files[content_hash],
+                                       content_hash,
+                                       parent)
+            pool = ThreadPool(self.UPLOAD_THREADS)
+            try:
+                pool.map(upload, missing)
+            finally:
+                pool.close()
+                pool.join()
+                self.attachments.save()
+
+        return replace_references(
+            content,
+            dict((ATTACHMENT_SCHEME + content_hash,
+                  self.attachments.url_for(content_hash))
+                 for content_hash in hashes))
+
+    def make_meeting_minute_blindly(self, content, date=None):
+        """Takes the HTML content
+        assumes that the page doesn't already exist.
+        Returns the MirroredPage of the new page"""
+        if not self.mirror_refreshed:
+            self.refresh_mirror()
+        return self.create_page(
+            self.meeting_minute_name(date),
+            content,
+            self.mirror.root_id)
+
+    def get_meeting_minute_page(self, date=None):
+        """Returns the meeting minute page for the given date (by default
+        today), or None if one doesn't already exist"""
+        return self.find_page(self.meeting_minute_path(date))
 
     def yes_no_none(self, response):
         response = response.lower()
@@ -145,21 +894,86 @@ class SitesCommunicator(object):
             else:
                 print "Please answer yes or no"
 
-    def overwrite_existing_page(self, page, content):
-        self.client.Delete(page)
-        self.make_meeting_minute_blindly(content)
+    def overwrite_existing_page(self, page, content, date=None):
+        self.delete_page(page, content)
+        self.make_meeting_minute_blindly(content, date)
         # According to the docs, the following two lines should work
         # However, it will completely strip out the HTML tags
         #page.content.html = content
         #self.client.Update( page )
 
-    def make_meeting_minute(self, content):
-        existing = self.get_meeting_minute_page()
-        if (existing and 
-            self.yes_no_prompt("Overwrite existing minutes")):
-            self.overwrite_existing_page(existing, content)
+    def make_meeting_minute(self, content, date=None):
+        """Uploads the minutes for the given date, which defaults to today.
+        Nothing is sent if the content is the same as was last uploaded"""
+        path = self.meeting_minute_path(date)
+        self.journal.write(path, self.hashes.content_hash(content),
+                           "converted")
+        existing = self.lookup_page(path, content)
+        if existing and self.hashes.unchanged(path, content):
+            print "{0} are unchanged".format(self.meeting_minute_name(date))
+        elif (existing and 
+            self.confirm_overwrite(path, content)):
+            self.overwrite_existing_page(existing, content, date)
+            self.hashes.record(path, content)
         elif not existing:
-            self.make_meeting_minute_blindly(content)
+            self.make_meeting_minute_blindly(content, date)
+            self.hashes.record(path, content)
+        self.hashes.save()
+        self.mirror.save()
+
+    def upload_chunk(self, parent, chunk, replace, date=None):
+        """Creates the subpage for a single chunk under the given parent.
+        If replace is set, any existing subpage by the same name is
+        deleted first"""
+        path = "{0}/{1}".format(self.meeting_minute_path(date),
+                                chunk.page_name)
+        if replace:
+            existing = self.lookup_page(path, chunk.content)
+            if existing:
+                self.delete_page(existing, chunk.content)
+        self.create_page(chunk.title, chunk.content, parent.id,
+                         chunk.page_name)
+        self.hashes.record(path, chunk.content)
+
+    def upload_chunks(self, parent, chunks, replace, date=None):
+        """Uploads the given chunks concurrently"""
+        pool = ThreadPool(self.UPLOAD_THREADS)
+        try:
+            pool.map(lambda chunk: self.upload_chunk(parent, chunk, replace,
+                                                     date),
+                     chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def make_chunked_meeting_minute(self, sections, date=None):
+        """Uploads the minutes for the given date (by default today) as an
+        index page with one subpage per section.  If the index is unchanged
+        since the last upload, only the subpages whose content has changed
+        are sent again"""
+        path = self.meeting_minute_path(date)
+        index, chunks = chunk_sections(sections,
+                                       self.meeting_minute_url(date))
+        self.journal.write(path, self.hashes.content_hash(index),
+                           "converted")
+        existing = self.lookup_page(path, index)
+        if existing and self.hashes.unchanged(path, index):
+            changed = [chunk for chunk in chunks
+                       if not self.hashes.unchanged(
+                           "{0}/{1}".format(path, chunk.page_name),
+                           chunk.content)]
+            self.upload_chunks(existing, changed, True, date)
+        elif (not existing or
+              self.confirm_overwrite(path, index)):
+            if existing:
+                # deleting the index takes its subpages with it
+                self.delete_page(existing, index)
+            self.hashes.forget_below(path)
+            parent = self.make_meeting_minute_blindly(index, date)
+            self.hashes.record(path, index)
+            self.upload_chunks(parent, chunks, False, date)
+        self.hashes.save()
+        self.mirror.save()
 
 
 def read_raw_file(filename):
@@ -174,23 +988,132 @@ def file_extension(filename):
     _, extension = os.path.splitext(filename)
     return extension
 
-def read_formatted(filename):
-    """Reads in the given file, making sure it's in HTML format
-    assumes that html files end in .html"""
+def converter_for(filename, chunk):
+    """Gets the function that converts the lines of the given file to HTML,
+    or to notes_parser.Sections if chunk is set"""
     extension = file_extension(filename)
-    if extension in file_extension_parsers:
-        contents = read_raw_file(filename).split("\n")
-        return file_extension_parsers[extension](contents)
+    if chunk and extension in file_extension_splitters:
+        return file_extension_splitters[extension]
+    elif chunk:
+        raise Exception(
+            "Cannot split files with extension: {0}".format(extension))
+    elif extension in file_extension_parsers:
+        return file_extension_parsers[extension]
     else:
         raise Exception(
             "Unknown file extension: {0}".format(extension))
 
+def read_converted(filename, chunk):
+    """Reads in the given file, converted to HTML, or to
+    notes_parser.Sections if chunk is set"""
+    contents = read_raw_file(filename).split("\n")
+    return converter_for(filename, chunk)(contents)
+
+def file_directory(filename):
+    """Gets the directory that references in the given file are
+    relative to"""
+    return os.path.dirname(os.path.abspath(filename))
+
+def upload_converted(sc, converted, chunk, base_dir, date=None):
+    """Uploads converted notes along with any files they refer to.
+    converted is HTML, or a list of notes_parser.Sections if chunk is set"""
+    if chunk:
+        for section in converted:
+            section.body = sc.pin_attachments(section.body, base_dir)
+        sc.make_chunked_meeting_minute(converted, date)
+    else:
+        content = sc.pin_attachments(converted, base_dir)
+        sc.make_meeting_minute(content, date)
+
+# formats of the lines that start each day's notes in an archive
+ARCHIVE_DATE_FORMATS = ["%Y-%m-%d", "%b %d, %Y"]
+
+def archive_date(line):
+    """Returns the date on the given line if the line holds nothing but
+    a date in one of the archive formats, or None otherwise"""
+    for date_format in ARCHIVE_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(line.strip(), date_format)
+        except ValueError:
+            pass
+    return None
+
+def archive_sections(fh):
+    """Reads an archive holding notes for many days from the given file
+    handle, one line at a time.  Yields a (date, lines) pair as each day's
+    notes are finished"""
+    date = None
+    lines = []
+    for line in fh:
+        line = line.rstrip("\n")
+        next_date = archive_date(line)
+        if next_date:
+            if date:
+                yield date, lines
+            date = next_date
+            lines = []
+        elif date:
+            lines.append(line)
+        elif line.strip():
+            raise Exception(
+                "Archive has notes before the first date: {0}".format(line))
+    if date:
+        yield date, lines
+
+def check_archive_dates(fh):
+    """Raises an exception if the archive read from the given file handle
+    holds notes for the same date more than once, since each would
+    otherwise overwrite the last"""
+    seen = set()
+    for line in fh:
+        date = archive_date(line)
+        if date and date in seen:
+            raise Exception(
+                "Archive has notes for {0} more than once".format(
+                    date.strftime("%Y-%m-%d")))
+        elif date:
+            seen.add(date)
+
+def sync_archive(sc, filename, chunk):
+    """Uploads each day of the given archive as its own meeting minute"""
+    convert = converter_for(filename, chunk)
+    base_dir = file_directory(filename)
+    with open(filename, "r") as fh:
+        check_archive_dates(fh)
+    with open(filename, "r") as fh:
+        for date, lines in archive_sections(fh):
+            upload_converted(sc, convert(lines), chunk, base_dir, date)
+
+def option_parser():
+    parser = optparse.OptionParser(usage="%prog [options] notes_file")
+    parser.add_option(
+        "-c", "--chunk", action="store_true", default=False,
+        help="upload each top-level header of a .notes file as its " +
+        "own subpage, linked from an index page")
+    parser.add_option(
+        "-a", "--archive", action="store_true", default=False,
+        help="treat the file as notes for many days, each starting with " +
+        "a line holding only its date, e.g. 2012-02-12 or Feb 12, 2012")
+    parser.add_option(
+        "-r", "--resume", action="store_true", default=False,
+        help="carry on from where an interrupted sync left off")
+    return parser
+
 # BEGIN MAIN
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        content = read_formatted(sys.argv[1])
-        sc = SitesCommunicator()
-        sc.make_meeting_minute(content)
+    options, args = option_parser().parse_args()
+    if len(args) == 1 and options.archive:
+        # fail on unknown extensions before bothering to authenticate
+        converter_for(args[0], options.chunk)
+        sc = SitesCommunicator(args[0], options.resume)
+        sync_archive(sc, args[0], options.chunk)
+        sc.finish()
+    elif len(args) == 1:
+        converted = read_converted(args[0], options.chunk)
+        sc = SitesCommunicator(args[0], options.resume)
+        upload_converted(sc, converted, options.chunk,
+                         file_directory(args[0]))
+        sc.finish()
     else:
         print "Needs the name of a notes file to upload. Files ending in HTML" + \
             " are uploaded as-is, while files ending in either .txt or .notes" + \
@@ -1,5 +1,8 @@
 from notes_parser import *
+from notes_fuzz import differential_run
+import notes_reference
 import unittest
+import sys
 
 class TestParsers(unittest.TestCase):
     def test_num_leading_whitespace1(self):
@@ -24,6 +27,46 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(
             chomp_string("something:", ":"), "something")
 
+    def test_or_parsers1(self):
+        parser = or_parsers(HeaderParser(), ListHeaderParser())
+        self.assertEqual(
+            parser.parse(to_lines("-a\nFOO")).parsed,
+            "<ul>\n<li>a FOO</li>\n</ul>\n")
+
+    def test_or_parsers2(self):
+        parser = or_parsers(HeaderParser(), ListHeaderParser(), BreakParser())
+        res = parser.parse(["some text"])
+        self.assertEqual(res.parsed, "")
+        self.assertEqual(res.remaining, ["some text"])
+
+    def test_memoized(self):
+        calls = []
+        class CountingParser(BreakParser):
+            def parse_at(self, lines, index):
+                calls.append(index)
+                return super(CountingParser, self).parse_at(lines, index)
+        memo = MemoTable()
+        counting = CountingParser().memoized(memo)
+        parser = or_parsers(and_parsers(HeaderParser(), counting),
+                            counting)
+        self.assertEqual(parser.parse(["text", ""]).parsed, "")
+        self.assertEqual(calls, [0])
+
+    def test_memo_bounded(self):
+        memo = MemoTable(2)
+        parser = BreakParser()
+        for index in range(3):
+            memo.store(parser, index, IndexResult("", index))
+        self.assertTrue(len(memo.table) <= 2)
+        self.assertEqual(memo.lookup(parser, 0), None)
+        self.assertEqual(memo.lookup(parser, 2), IndexResult("", 2))
+
+    def test_parse_at(self):
+        self.assertEqual(
+            and_parsers(HeaderParser(), BreakParser()).parse_at(
+                ["text", "FOO", "", "bar"], 1),
+            IndexResult("<h3>Foo</h3>\n<br/>\n", 3))
+
     def test_header1(self):
         self.assertEqual(
             HeaderParser().parse(["FOO:"]).parsed,
@@ -84,6 +127,44 @@ class TestParsers(unittest.TestCase):
                 to_lines("-outer1\n -inner\n-outer2")).parsed,
             "<ul>\n<li>outer1</li>\n<ul>\n<li>inner</li>\n</ul>\n<li>outer2</li>\n</ul>\n")
 
+    def test_list_header3(self):
+        self.assertEqual(
+            ListHeaderParser().parse(
+                to_lines("-outer1\n    -inner1\n  -inner2\n-outer2")).parsed,
+            "<ul>\n<li>outer1</li>\n" +
+            "<ul>\n<li>inner1</li>\n</ul>\n" +
+            "<ul>\n<li>inner2</li>\n</ul>\n" +
+            "<li>outer2</li>\n</ul>\n")
+
+    def test_list_header4(self):
+        res = ListHeaderParser().parse(to_lines(" -inner\n-outer"))
+        self.assertEqual(res.parsed, "<ul>\n<li>inner</li>\n</ul>\n")
+        self.assertEqual(res.remaining, ["-outer"])
+
+    def test_list_header_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        lines = [" " * i + "-x" for i in range(depth)]
+        parsed = ListHeaderParser().parse(lines).parsed
+        self.assertEqual(parsed.count("<ul>"), depth)
+        self.assertEqual(parsed.count("</ul>"), depth)
+
+    def test_reference1(self):
+        self.assertEqual(
+            ReferenceParser().parse(["![A \"B\"](shots/a b.png)"]).parsed,
+            "")
+
+    def test_reference2(self):
+        res = ReferenceParser().parse(to_lines(" ![A & B](shot.png)\nfoo"))
+        self.assertEqual(
+            res.parsed,
+            "<p><img src=\"shot.png\" alt=\"A &amp; B\"/></p>\n")
+        self.assertEqual(res.remaining, ["foo"])
+
+    def test_reference3(self):
+        self.assertEqual(
+            ReferenceParser().parse(["[](slides.pdf)"]).parsed,
+            "<p><a href=\"slides.pdf\">slides.pdf</a></p>\n")
+
     def test_break1(self):
         self.assertEqual(
             BreakParser().parse(
@@ -138,6 +219,60 @@ class TestParsers(unittest.TestCase):
             "<p>some free text </p>\n" +
             "<br/>\n")
 
+    def test_split_sections1(self):
+        self.assertEqual(
+            split_sections("<p>intro </p>\n"),
+            [Section(None, "<p>intro </p>\n")])
+
+    def test_split_sections2(self):
+        self.assertEqual(
+            Notes2HTML().convert_sections(
+                to_lines("FOO:\n-a\n\nBAR & BAZ:\nsome text")),
+            [Section(None, ""),
+             Section("Foo",
+                     "<h3>Foo</h3>\n<ul>\n<li>a</li>\n</ul>\n<br/>\n"),
+             Section("Bar & Baz",
+                     "<h3>Bar &amp; Baz</h3>\n<p>some text </p>\n")])
+
+    def test_combo_reference(self):
+        self.assertEqual(
+            NotesParser().parse(
+                to_lines("some text\n![DIAGRAM](d.png)\nFOO:")).parsed,
+            "<p>some text </p>\n" +
+            "<p><img src=\"d.png\" alt=\"DIAGRAM\"/></p>\n" +
+            "<h3>Foo</h3>\n")
+
+    def test_combo_memoized(self):
+        lines = to_lines("HEADER:\n\n-outer1\n -inner1\n-outer2\n\nsome text\n")
+        self.assertEqual(
+            NotesParser(memoize=True).parse(lines).parsed,
+            NotesParser().parse(lines).parsed)
+
+    def test_reference_list_header(self):
+        lines = ["-outer1", "  -inner1", " -inner2", "  -inner3",
+                 "-outer2", "", "text"]
+        reference = notes_reference.ListHeaderParser().parse(lines)
+        res = ListHeaderParser().parse(lines)
+        self.assertEqual((res.parsed, res.remaining),
+                         (reference.parsed, reference.remaining))
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Notes2HTML, "no-such-engine")
+
+    def test_engines_match_reference(self):
+        for engine in ENGINES:
+            for report in differential_run(engine, count=20):
+                self.assertEqual(report.mismatches, [],
+                                 "{0} on {1}".format(engine, report.name))
+
+    def test_differential_run_catches_mismatch(self):
+        class SloppyParser(NotesParser):
+            def parse(self, lines):
+                res = super(SloppyParser, self).parse(lines)
+                return ParseResult(res.parsed.replace("<br/>", "<br>"),
+                                   res.remaining)
+        reports = differential_run(SloppyParser, count=20)
+        self.assertTrue(any(report.mismatches for report in reports))
 
 if __name__ == "__main__":
     unittest.main()
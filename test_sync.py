@@ -0,0 +1,555 @@
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from StringIO import StringIO
+
+try:
+    import gdata.sites.client
+except ImportError:
+    # nothing tested here talks to the site, so empty stand-ins for
+    # gdata are enough to import sync
+    for name in ["gdata", "gdata.client", "gdata.sites",
+                 "gdata.sites.client", "gdata.sites.data", "gdata.gauth"]:
+        sys.modules[name] = types.ModuleType(name)
+    class RequestError(Exception):
+        pass
+    sys.modules["gdata.client"].RequestError = RequestError
+    sys.modules["gdata"].client = sys.modules["gdata.client"]
+
+from sync import *
+from notes_parser import Notes2HTML, Section, to_lines
+
+def html(body):
+    return Notes2HTML().to_html(body)
+
+class FakeLink(object):
+    def __init__(self, href):
+        self.href = href
+
+class FakeEntry(object):
+    """Enough of a gdata.sites.data.ContentEntry for sync"""
+    def __init__(self, entry_id, parent_id, page_name, href):
+        self.id = FakeLink(entry_id)
+        self.id.text = entry_id
+        self.parent_id = parent_id
+        self.page_name = FakeLink(page_name)
+        self.page_name.text = page_name
+        self.href = href
+
+    def FindParentLink(self):
+        return self.parent_id
+
+    def GetEditLink(self):
+        return FakeLink("edit-" + self.id.text)
+
+    def GetAlternateLink(self):
+        return FakeLink(self.href)
+
+class FakeClient(object):
+    """Stands in for gdata.sites.client.SitesClient, writing down each
+    request it is sent in requests"""
+    def __init__(self):
+        self.requests = []
+        self.root = FakeEntry("root", None, "notes", "http://site/notes")
+        self.lock = threading.Lock()
+
+    def request(self, *request):
+        with self.lock:
+            self.requests.append(request)
+
+    def MakeContentFeedUri(self):
+        return "feed"
+
+    def GetContentFeed(self, uri):
+        self.request("feed", uri)
+        return FakeFeed([self.root])
+
+    def UploadAttachment(self, filename, parent, content_type, title):
+        self.request("upload", filename, parent, content_type)
+        return FakeEntry(title, parent.id.text, None, "http://site/" + title)
+
+    def CreatePage(self, kind, title, html, page_name, parent):
+        self.request("create", title, html)
+        return FakeEntry("new-" + title, parent,
+                         page_name or page_name_for_title(title), None)
+
+    def Delete(self, edit_link, force):
+        self.request("delete", edit_link)
+
+class FakeFeed(object):
+    def __init__(self, entry):
+        self.entry = entry
+
+class FakeGovernor(object):
+    def acquire(self):
+        pass
+
+    def report(self, latency, throttled):
+        pass
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def temp_file(self, name):
+        return os.path.join(self.directory, name)
+
+    def make_mirror(self):
+        mirror = PageMirror(self.temp_file("mirror.txt"), "/notes")
+        mirror.root_id = "root"
+        mirror.root_node_id = "1"
+        for fields in [("day", "root", "minutes-for-x", "edit-day"),
+                       ("foo", "day", "foo", "edit-foo"),
+                       ("bar", "foo", "bar", "edit-bar"),
+                       ("file", "day", None, "edit-file"),
+                       ("stray", "elsewhere", "stray", "edit-stray")]:
+            mirror.add_page(MirroredPage(*fields))
+        return mirror
+
+    def test_mirror_path_of(self):
+        mirror = self.make_mirror()
+        self.assertEqual(mirror.path_of(mirror.pages["bar"]),
+                         "/notes/minutes-for-x/foo/bar")
+        self.assertEqual(mirror.path_of(mirror.pages["file"]), None)
+        self.assertEqual(mirror.path_of(mirror.pages["stray"]), None)
+
+    def test_mirror_find(self):
+        mirror = self.make_mirror()
+        self.assertEqual(mirror.find("/notes/minutes-for-x/foo").id, "foo")
+        self.assertEqual(mirror.find("/notes/stray"), None)
+
+    def test_mirror_remove(self):
+        mirror = self.make_mirror()
+        self.assertEqual(mirror.find("/notes/minutes-for-x/foo").id, "foo")
+        mirror.remove("foo")
+        self.assertEqual(sorted(mirror.pages), ["day", "file", "stray"])
+        self.assertEqual(mirror.find("/notes/minutes-for-x/foo"), None)
+
+    def test_mirror_save(self):
+        self.make_mirror().save()
+        loaded = PageMirror(self.temp_file("mirror.txt"), "/notes")
+        self.assertEqual(loaded.root_node_id, "1")
+        self.assertEqual(loaded.find("/notes/minutes-for-x/foo/bar").edit_link,
+                         "edit-bar")
+        other = PageMirror(self.temp_file("mirror.txt"), "/other")
+        self.assertEqual((other.root_id, other.pages), (None, {}))
+
+    def test_mirror_torn(self):
+        mirror = self.make_mirror()
+        mirror.updated = "2012-02-12T00:00:00.000Z"
+        mirror.save()
+        with open(mirror.filename, "r+") as fh:
+            fh.truncate(40)
+        loaded = PageMirror(mirror.filename, "/notes")
+        self.assertEqual(loaded.root_id, None)
+        self.assertEqual(loaded.updated, None)
+        self.assertEqual(loaded.pages, {})
+
+    def test_mirror_threads(self):
+        mirror = self.make_mirror()
+        for n in range(500):
+            mirror.add_page(MirroredPage(str(n), "day", str(n), "edit"))
+        errors = []
+        def churn(offset):
+            try:
+                for n in range(offset, 500, 2):
+                    mirror.find("/notes/minutes-for-x/{0}".format(n))
+                    mirror.add_page(
+                        MirroredPage(str(n), "day", str(n), "edit"))
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=churn, args=(offset,))
+                   for offset in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_hashes_save(self):
+        filename = self.temp_file("hashes.txt")
+        hashes = HashManifest(filename)
+        hashes.record("/notes/a", "a")
+        hashes.save()
+        self.assertTrue(HashManifest(filename).unchanged("/notes/a", "a"))
+        self.assertEqual(os.listdir(self.directory), ["hashes.txt"])
+
+    def test_hashes_torn(self):
+        filename = self.temp_file("hashes.txt")
+        with open(filename, "w") as fh:
+            fh.write('{"/notes/a": "86f7e437faa5a7fce15d1dd')
+        self.assertEqual(HashManifest(filename).hashes, {})
+
+    def test_page_name_for_title(self):
+        self.assertEqual(
+            page_name_for_title("Bar & Baz: 2"), "bar-baz-2")
+
+    def test_chunk_sections1(self):
+        sections = Notes2HTML().convert_sections(
+            to_lines("intro\nFOO:\nfoo text\nFOO\nBAR & BAZ:\n-a"))
+        index, chunks = chunk_sections(sections, "minutes-for-x")
+        self.assertEqual(
+            index,
+            html("<p>intro </p>\n<ul>\n" +
+                 "<li><a href=\"minutes-for-x/foo\">Foo</a></li>\n" +
+                 "<li><a href=\"minutes-for-x/foo-2\">Foo</a></li>\n" +
+                 "<li><a href=\"minutes-for-x/bar-baz\">Bar &amp; Baz</a>" +
+                 "</li>\n</ul>\n"))
+        self.assertEqual(
+            [(chunk.title, chunk.page_name) for chunk in chunks],
+            [("Foo", "foo"), ("Foo", "foo-2"), ("Bar & Baz", "bar-baz")])
+        self.assertEqual(
+            chunks[0].content,
+            html("<h3>Foo</h3>\n<p>foo text </p>\n"))
+
+    def test_chunk_sections2(self):
+        index, chunks = chunk_sections(
+            [Section(None, ""), Section("!!!", "<h3>!!!</h3>\n")], "m")
+        self.assertEqual(chunks[0].page_name, "section")
+
+    def test_archive_date(self):
+        self.assertEqual(archive_date("2012-02-12\n"),
+                         datetime.datetime(2012, 2, 12))
+        self.assertEqual(archive_date(" Feb 12, 2012 "),
+                         datetime.datetime(2012, 2, 12))
+        self.assertEqual(archive_date("-2012-02-12"), None)
+        self.assertEqual(archive_date("Notes for Feb 12, 2012"), None)
+
+    def test_archive_sections1(self):
+        archive = StringIO("\n2012-02-12\n-a\n\nFeb 13, 2012\n-b\n")
+        self.assertEqual(
+            list(archive_sections(archive)),
+            [(datetime.datetime(2012, 2, 12), ["-a", ""]),
+             (datetime.datetime(2012, 2, 13), ["-b"])])
+
+    def test_archive_sections2(self):
+        archive = StringIO("-a\n2012-02-12\n-b\n")
+        self.assertRaises(Exception, list, archive_sections(archive))
+
+    def test_archive_duplicate_dates(self):
+        check_archive_dates(StringIO("2012-02-12\n-a\n2012-02-13\n"))
+        self.assertRaisesRegexp(
+            Exception, "2012-02-12 more than once",
+            check_archive_dates,
+            StringIO("2012-02-12\n-a\nFeb 12, 2012\n-b\n"))
+
+    def test_sync_archive_duplicate_dates(self):
+        filename = self.temp_file("archive.notes")
+        with open(filename, "w") as fh:
+            fh.write("2012-02-12\n-a\n2012-02-13\n-b\n2012-02-12\n-c\n")
+        uploads = []
+        class Recorder(object):
+            def __getattr__(self, name):
+                uploads.append(name)
+                raise AttributeError(name)
+        self.assertRaisesRegexp(Exception, "more than once",
+                                sync_archive, Recorder(), filename, False)
+        self.assertEqual(uploads, [])
+
+    def make_communicator(self, answers):
+        """A SitesCommunicator that never talks to the site, answering
+        yes/no questions from the given list"""
+        sc = SitesCommunicator.__new__(SitesCommunicator)
+        sc.hashes = HashManifest(self.temp_file("hashes.txt"))
+        sc.questions = []
+        def yes_no_prompt(text_prompt):
+            sc.questions.append(text_prompt)
+            return answers.pop(0)
+        sc.yes_no_prompt = yes_no_prompt
+        return sc
+
+    def interrupted_journal(self, filename):
+        journal = SyncJournal(filename)
+        journal.write("/notes/a", "hash-a", "created")
+        journal.write("/notes/b", "hash-b", "looked-up", exists=True,
+                      overwrite=False)
+        journal.write("/notes/c", "hash-c", "deleted", page_id="c")
+        journal.fh.close()
+
+    def test_journal_filename(self):
+        directory = self.temp_file("journals")
+        filename = journal_filename(directory, "a.notes")
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(
+            filename, journal_filename(directory, os.path.abspath("a.notes")))
+        self.assertNotEqual(filename, journal_filename(directory, "b.notes"))
+
+    def test_journal_resume(self):
+        filename = self.temp_file("journal.txt")
+        self.interrupted_journal(filename)
+        journal = SyncJournal(filename)
+        self.assertTrue(journal.unfinished())
+        self.assertEqual(journal.created(), [("/notes/a", "hash-a")])
+        self.assertTrue(journal.previously_deleted("/notes/c"))
+        self.assertFalse(journal.previously_deleted("/notes/b"))
+        self.assertEqual(journal.previous_record("/notes/b", "other"), None)
+        journal.write("/notes/c", "hash-c", "created")
+        self.assertFalse(journal.previously_deleted("/notes/c"))
+        journal.finish()
+        self.assertFalse(os.path.exists(filename))
+
+    def test_journal_torn(self):
+        filename = self.temp_file("journal.txt")
+        self.interrupted_journal(filename)
+        with open(filename, "a") as fh:
+            fh.write('{"path": "/notes/d", "ha')
+        journal = SyncJournal(filename)
+        self.assertEqual(sorted(journal.previous),
+                         ["/notes/a", "/notes/b", "/notes/c"])
+        journal.write("/notes/d", "hash-d", "created")
+        journal.fh.close()
+        journal = SyncJournal(filename)
+        self.assertEqual(sorted(journal.created()),
+                         [("/notes/a", "hash-a"), ("/notes/d", "hash-d")])
+
+    def test_journal_locked(self):
+        filename = self.temp_file("journal.txt")
+        journal = SyncJournal(filename)
+        self.assertRaises(Exception, SyncJournal, filename)
+        journal.finish()
+        SyncJournal(filename).finish()
+
+    def test_resume_seeds_hashes(self):
+        directory = self.temp_file("journals")
+        self.interrupted_journal(journal_filename(directory, "a.notes"))
+        sc = self.make_communicator([])
+        sc.open_journal(directory, "a.notes", True)
+        self.assertEqual(sc.hashes.hashes, {"/notes/a": "hash-a"})
+        self.assertEqual(sc.questions, [])
+
+    def test_resume_reuses_overwrite(self):
+        directory = self.temp_file("journals")
+        self.interrupted_journal(journal_filename(directory, "a.notes"))
+        sc = self.make_communicator([True])
+        sc.hashes.content_hash = lambda content: "hash-" + content
+        sc.open_journal(directory, "a.notes", True)
+        self.assertFalse(sc.confirm_overwrite("/notes/b", "b"))
+        self.assertTrue(sc.confirm_overwrite("/notes/a", "a"))
+        self.assertEqual(len(sc.questions), 1)
+
+    def resume_lookup(self, page_id):
+        """Looks up the foo page after a sync that deleted the page with
+        the given id, in order to replace foo, was interrupted"""
+        directory = self.temp_file("journals")
+        journal = SyncJournal(journal_filename(directory, "a.notes"))
+        journal.write("/notes/minutes-for-x/foo", "hash-foo", "deleted",
+                      page_id=page_id)
+        journal.fh.close()
+        sc = self.make_communicator([])
+        sc.open_journal(directory, "a.notes", True)
+        sc.mirror = self.make_mirror()
+        sc.mirror_refreshed = True
+        return sc, sc.lookup_page("/notes/minutes-for-x/foo", "foo")
+
+    def test_resume_after_delete(self):
+        # the mirror has yet to notice the deletion
+        sc, existing = self.resume_lookup("foo")
+        self.assertEqual(existing, None)
+        self.assertEqual(sc.mirror.find("/notes/minutes-for-x/foo"), None)
+        self.assertEqual(sc.journal.created(), [])
+
+    def test_resume_after_create(self):
+        # the replacement was created, but never written down
+        sc, existing = self.resume_lookup("old-foo")
+        self.assertEqual(existing.id, "foo")
+        with open(sc.journal.filename, "r") as fh:
+            records = [json.loads(line) for line in fh]
+        self.assertEqual(
+            [record["state"] for record in records
+             if record["path"] == "/notes/minutes-for-x/foo"],
+            ["deleted", "created", "looked-up"])
+        self.assertEqual(sc.hashes.hashes,
+                         {"/notes/minutes-for-x/foo": "hash-foo"})
+        self.assertFalse(
+            sc.journal.previously_deleted("/notes/minutes-for-x/foo"))
+
+    def test_unfinished_without_resume(self):
+        directory = self.temp_file("journals")
+        filename = journal_filename(directory, "a.notes")
+        self.interrupted_journal(filename)
+        sc = self.make_communicator([False])
+        self.assertRaisesRegexp(Exception, "--resume",
+                                sc.open_journal, directory, "a.notes", False)
+        sc.journal.fh.close()
+        self.assertTrue(os.path.getsize(filename) > 0)
+        sc = self.make_communicator([True])
+        sc.open_journal(directory, "a.notes", False)
+        self.assertFalse(sc.journal.unfinished())
+        self.assertEqual(sc.journal.created(), [])
+        self.assertEqual(sc.hashes.hashes, {})
+
+    def test_unfinished_other_file(self):
+        directory = self.temp_file("journals")
+        self.interrupted_journal(journal_filename(directory, "a.notes"))
+        sc = self.make_communicator([])
+        sc.open_journal(directory, "b.notes", False)
+        self.assertFalse(sc.journal.unfinished())
+        self.assertTrue(os.path.getsize(
+            journal_filename(directory, "a.notes")) > 0)
+
+    def governor_state(self, rate, tokens, elapsed):
+        return {"rate": rate, "tokens": tokens,
+                "stamp": time.time() - elapsed}
+
+    def test_take_token1(self):
+        governor = RateGovernor(self.temp_file("rate.txt"))
+        # a stamp in the future means no time has passed
+        state = self.governor_state(2.0, 1.5, -60)
+        self.assertEqual(governor.take_token(state), 0)
+        self.assertAlmostEqual(state["tokens"], 0.5)
+        self.assertAlmostEqual(governor.take_token(state), 0.25, places=2)
+        self.assertAlmostEqual(state["tokens"], 0.5, places=2)
+
+    def test_take_token2(self):
+        governor = RateGovernor(self.temp_file("rate.txt"))
+        # a long idle spell fills the bucket no further than the rate
+        state = self.governor_state(4.0, 0.0, 60)
+        self.assertEqual(governor.take_token(state), 0)
+        self.assertAlmostEqual(state["tokens"], 3.0, places=2)
+        state = self.governor_state(0.5, 0.0, 60)
+        self.assertEqual(governor.take_token(state), 0)
+        self.assertAlmostEqual(state["tokens"], 0.0, places=2)
+
+    def test_adjust_rate(self):
+        governor = RateGovernor(self.temp_file("rate.txt"))
+        state = {"rate": 2.0}
+        governor.adjust_rate(state, 0.1, False)
+        self.assertAlmostEqual(state["rate"], 2.05)
+        governor.adjust_rate(state, 5.0, False)
+        self.assertAlmostEqual(state["rate"], 1.64)
+        governor.adjust_rate(state, 0.1, True)
+        self.assertAlmostEqual(state["rate"], 0.82)
+        state = {"rate": RateGovernor.MIN_RATE}
+        governor.adjust_rate(state, 0.1, True)
+        self.assertEqual(state["rate"], RateGovernor.MIN_RATE)
+        state = {"rate": RateGovernor.MAX_RATE}
+        governor.adjust_rate(state, 0.1, False)
+        self.assertEqual(state["rate"], RateGovernor.MAX_RATE)
+
+    def test_governor_shared(self):
+        filename = self.temp_file("rate.txt")
+        RateGovernor(filename).report(0.1, True)
+        self.assertAlmostEqual(
+            RateGovernor(filename).with_state(lambda state: state["rate"]),
+            RateGovernor.INITIAL_RATE * RateGovernor.THROTTLED_DECREASE)
+
+    def test_local_file(self):
+        notes = self.temp_file("notes")
+        os.makedirs(os.path.join(notes, "figures"))
+        for name in ["figures/plot.png", "../secret.txt"]:
+            with open(os.path.join(notes, name), "w") as fh:
+                fh.write("x")
+        os.symlink(self.temp_file("secret.txt"),
+                   os.path.join(notes, "link.txt"))
+        plot = os.path.realpath(os.path.join(notes, "figures", "plot.png"))
+        self.assertEqual(local_file("figures/plot.png", notes), plot)
+        self.assertEqual(local_file(plot, notes), plot)
+        self.assertEqual(local_file("figures/../figures/plot.png", notes),
+                         plot)
+        self.assertEqual(local_file("figures/missing.png", notes), None)
+        self.assertEqual(local_file("figures", notes), None)
+        self.assertEqual(local_file("../secret.txt", notes), None)
+        self.assertEqual(local_file(self.temp_file("secret.txt"), notes),
+                         None)
+        self.assertEqual(local_file("link.txt", notes), None)
+        self.assertEqual(local_file("http://site/plot.png", notes), None)
+
+    def make_site_communicator(self, answers):
+        """Like make_communicator, but talking to a FakeClient, with the
+        minutes for Feb 12, 2012 already on the site"""
+        sc = self.make_communicator(answers)
+        sc.client = FakeClient()
+        sc.governor = FakeGovernor()
+        sc.MEETING_MINUTES = "/notes"
+        sc.UPLOAD_THREADS = 2
+        sc.root = None
+        sc.mirror = PageMirror(self.temp_file("mirror.txt"), "/notes")
+        sc.mirror.root_id = "root"
+        sc.mirror.root_node_id = "1"
+        sc.mirror.add_page(MirroredPage("day", "root",
+                                        "minutes-for-feb-12-2012",
+                                        "edit-day"))
+        sc.mirror_refreshed = True
+        sc.attachments = AttachmentManifest(self.temp_file("files.txt"))
+        sc.attachment_files = {}
+        sc.attachment_lock = threading.Lock()
+        sc.open_journal(self.temp_file("journals"), "a.notes", False)
+        return sc
+
+    def write_plot(self):
+        with open(self.temp_file("plot.png"), "wb") as fh:
+            fh.write("png")
+        return "http://site/{0}-plot.png".format(
+            HashManifest.content_hash("png")[:12])
+
+    def test_upload_attachments(self):
+        url = self.write_plot()
+        sc = self.make_site_communicator([])
+        content = sc.pin_attachments(
+            '<img src="plot.png"/><a href="plot.png">x</a>', self.directory)
+        pinned = ATTACHMENT_SCHEME + HashManifest.content_hash("png")
+        self.assertEqual(content,
+                         '<img src="{0}"/><a href="{0}">x</a>'.format(pinned))
+        self.assertEqual(sc.client.requests, [])
+        self.assertEqual(sc.upload_attachments(content),
+                         '<img src="{0}"/><a href="{0}">x</a>'.format(url))
+        self.assertEqual(sc.client.requests,
+                         [("feed", "feed?path=/notes"),
+                          ("upload", os.path.realpath(
+                              self.temp_file("plot.png")),
+                           sc.client.root, "image/png")])
+        # already uploaded, so nothing more is sent
+        sc.upload_attachments(content)
+        self.assertEqual(len(sc.client.requests), 2)
+
+    def test_declined_overwrite(self):
+        self.write_plot()
+        sc = self.make_site_communicator([False])
+        upload_converted(sc, '<img src="plot.png"/>', False, self.directory,
+                         datetime.datetime(2012, 2, 12))
+        self.assertEqual(len(sc.questions), 1)
+        self.assertEqual(sc.client.requests, [])
+
+    def test_accepted_overwrite(self):
+        url = self.write_plot()
+        sc = self.make_site_communicator([True])
+        upload_converted(sc, '<img src="plot.png"/>', False, self.directory,
+                         datetime.datetime(2012, 2, 12))
+        self.assertEqual([request[0] for request in sc.client.requests],
+                         ["delete", "feed", "upload", "create"])
+        self.assertEqual(sc.client.requests[-1][2],
+                         '<img src="{0}"/>'.format(url))
+        # nothing changed, so nothing is sent, even the file
+        sc.client.requests = []
+        sc.attachments.urls = {}
+        upload_converted(sc, '<img src="plot.png"/>', False, self.directory,
+                         datetime.datetime(2012, 2, 12))
+        self.assertEqual(sc.client.requests, [])
+
+    def test_chunked_attachments(self):
+        url = self.write_plot()
+        sc = self.make_site_communicator([True])
+        sections = [Section("Foo", '<h3>Foo</h3>\n<img src="plot.png"/>'),
+                    Section("Bar", '<h3>Bar</h3>\n<img src="plot.png"/>')]
+        upload_converted(sc, sections, True, self.directory,
+                         datetime.datetime(2012, 2, 12))
+        kinds = [request[0] for request in sc.client.requests]
+        self.assertEqual(kinds.count("upload"), 1)
+        self.assertTrue(kinds.index("upload") > kinds.index("create"))
+        self.assertEqual(
+            [request[2].count(url) for request in sc.client.requests
+             if request[0] == "create"],
+            [0, 1, 1])
+
+if __name__ == "__main__":
+    unittest.main()